@@ -1,11 +1,21 @@
 #!/usr/bin/env python3
 
+import asyncio
 import math
 import os
+import random
 import subprocess
 import sys
+from collections import deque
+from itertools import chain, product
 from pathlib import Path
 
+try:
+    import aiofiles
+    import aiohttp
+except ImportError:  # Fall back to batched curl downloads
+    aiohttp = None
+
 # Configuration
 MIN_LAT = 47.0    # Southern boundary
 MAX_LAT = 50.0    # Northern boundary  
@@ -18,6 +28,45 @@ MAX_ZOOM = 14
 OUTPUT_DIR = "shom_tiles_complete"
 BASE_URL = "https://services.data.shom.fr/clevisu/wmts"
 
+CONCURRENCY = 64  # Maximum number of tiles in flight
+TIMEOUT = 30      # Seconds per tile
+
+# Retry and rate limiting
+MAX_RETRIES = 5            # Attempts per tile before giving up
+REQUESTS_PER_SECOND = 100  # Token bucket rate shared by all workers
+THROTTLE_THRESHOLD = 10    # Number of 429 responses within THROTTLE_WINDOW...
+THROTTLE_WINDOW = 10       # ...seconds that pauses every worker...
+THROTTLE_PAUSE = 30        # ...for this many seconds
+
+STATIC_HEADERS = {
+    'Accept': 'image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8,*/*;q=0.5',
+    'Accept-Encoding': 'gzip, deflate',
+    'Accept-Language': 'en-US,en;q=0.5',
+    'Origin': 'https://data.shom.fr',
+    'Priority': 'u=5, i',
+    'Referer': 'https://data.shom.fr/',
+    'Sec-Fetch-Dest': 'image',
+    'Sec-Fetch-Mode': 'cors',
+    'Sec-Fetch-Site': 'same-site',
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:138.0) Gecko/20100101 Firefox/138.0',
+}
+
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+MIN_TILE_SIZE = 1000  # Minimum size for valid PNG, smaller responses are errors
+
+# curl fallback, used when aiohttp is not installed
+CURL_BATCH_SIZE = 200  # Tiles fetched per curl process
+CURL_PARALLEL = 32     # Transfers run concurrently by each curl process
+CURL_BASE = (
+    'curl', '-L', '--compressed', '-s',  # -s for silent
+    '--parallel', '--parallel-max', str(CURL_PARALLEL),
+    '--max-time', str(TIMEOUT),
+    '--retry', str(MAX_RETRIES - 1),  # Retries transient errors and 429s
+    '--write-out', '%{exitcode} %{http_code} %{filename_effective}\\n',  # One line per transfer
+)
+CURL_HEADER_ARGS = tuple(chain.from_iterable(
+    ('-H', f'{name}: {value}') for name, value in STATIC_HEADERS.items()))
+
 def deg2tile(lat, lon, zoom):
     """Convert lat/lon to tile coordinates (Web Mercator)"""
     lat_rad = math.radians(lat)
@@ -26,6 +75,21 @@ def deg2tile(lat, lon, zoom):
     y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
     return x, y
 
+def tile_ranges(min_lat, max_lat, min_lon, max_lon, zoom):
+    """Return the X and Y tile ranges covering a bounding box"""
+    n = 1 << zoom
+    min_x, max_y = deg2tile(min_lat, min_lon, zoom)
+    max_x, min_y = deg2tile(max_lat, max_lon, zoom)
+    
+    # Ensure we have the right bounds (min_y should be less than max_y)
+    if min_y > max_y:
+        min_y, max_y = max_y, min_y
+    
+    # Clamp to the tile grid (lon=180 or the poles fall outside it)
+    xs = range(max(min_x, 0), min(max_x, n - 1) + 1)
+    ys = range(max(min_y, 0), min(max_y, n - 1) + 1)
+    return xs, ys
+
 def tile2deg(x, y, zoom):
     """Convert tile coordinates back to lat/lon (for verification)"""
     n = 2.0 ** zoom
@@ -34,130 +98,315 @@ def tile2deg(x, y, zoom):
     lat = math.degrees(lat_rad)
     return lat, lon
 
-def download_tile(zoom, x, y, output_dir):
+class RateLimiter:
+    """Token bucket limiting the request rate to the SHOM server"""
+    
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = None
+        self.lock = asyncio.Lock()
+    
+    async def acquire(self):
+        """Wait until a request token is available and consume it"""
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            while True:
+                now = loop.time()
+                if self.updated is not None:
+                    self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Shared download state
+rate_limiter = RateLimiter(REQUESTS_PER_SECOND)
+pause_event = asyncio.Event()  # Cleared while the server is throttling us
+recent_throttles = deque()     # Timestamps of recent 429 responses
+stats = {'requests': 0, 'retries': 0, 'throttled': 0, 'pauses': 0}
+stats_lock = asyncio.Lock()
+
+async def record_throttle():
+    """Count a 429 response and pause every worker when they come in bursts"""
+    loop = asyncio.get_running_loop()
+    now = loop.time()
+    async with stats_lock:
+        stats['throttled'] += 1
+        recent_throttles.append(now)
+        while now - recent_throttles[0] > THROTTLE_WINDOW:
+            recent_throttles.popleft()
+        
+        if len(recent_throttles) >= THROTTLE_THRESHOLD and pause_event.is_set():
+            print(f"  Server is throttling requests, pausing for {THROTTLE_PAUSE}s...")
+            stats['pauses'] += 1
+            recent_throttles.clear()
+            pause_event.clear()
+            loop.call_later(THROTTLE_PAUSE, pause_event.set)
+
+def backoff_delay(attempt):
+    """Exponential backoff with jitter"""
+    return 2 ** attempt + random.random()
+
+def retry_after_delay(response, attempt):
+    """Delay requested by a 429 response, falling back to exponential backoff"""
+    try:
+        return max(float(response.headers.get('Retry-After', '')), 0)
+    except ValueError:
+        return backoff_delay(attempt)
+
+def tile_url(zoom, x, y):
+    """Build the WMTS GetTile URL for a tile"""
+    return (f"{BASE_URL}?"
+            f"layer=RASTER_MARINE_3857_WMTS&"
+            f"style=normal&"
+            f"tilematrixset=3857&"
+            f"Service=WMTS&"
+            f"Request=GetTile&"
+            f"Version=1.0.0&"
+            f"Format=image%2Fpng&"
+            f"TileMatrix={zoom}&"
+            f"TileCol={x}&"
+            f"TileRow={y}")
+
+def check_tile(outfile):
+    """Check a downloaded tile is a valid PNG, removing it otherwise"""
+    # Check if file exists and has content
+    if outfile.exists() and outfile.stat().st_size > MIN_TILE_SIZE:
+        # Verify it's actually a PNG
+        with open(outfile, 'rb') as f:
+            header = f.read(8)
+            if header == PNG_MAGIC:
+                return True, "downloaded"
+    
+    # If we get here, download failed
+    if outfile.exists():
+        outfile.unlink()  # Remove empty/invalid file
+        
+    return False, f"invalid_response"
+
+async def download_tile(session, semaphore, zoom, x, y, output_dir):
     """Download a single tile"""
-    outdir = Path(output_dir) / str(zoom) / str(x)
-    outdir.mkdir(parents=True, exist_ok=True)
-    outfile = outdir / f"{y}.png"
-    
-    # Skip if already exists
-    if outfile.exists() and outfile.stat().st_size > 0:
-        return True, "exists"
-    
-    # Construct URL
-    url = (f"{BASE_URL}?"
-           f"layer=RASTER_MARINE_3857_WMTS&"
-           f"style=normal&"
-           f"tilematrixset=3857&"
-           f"Service=WMTS&"
-           f"Request=GetTile&"
-           f"Version=1.0.0&"
-           f"Format=image%2Fpng&"
-           f"TileMatrix={zoom}&"
-           f"TileCol={x}&"
-           f"TileRow={y}")
-    
-    # Curl command
-    cmd = [
-        'curl', '-L', '--compressed', '-s',  # -s for silent
-        '-H', 'Accept: image/avif,image/webp,image/png,image/svg+xml,image/*;q=0.8,*/*;q=0.5',
-        '-H', 'Accept-Encoding: gzip, deflate, br, zstd',
-        '-H', 'Accept-Language: en-US,en;q=0.5',
-        '-H', 'Connection: keep-alive',
-        '-H', 'Host: services.data.shom.fr',
-        '-H', 'Origin: https://data.shom.fr',
-        '-H', 'Priority: u=5, i',
-        '-H', 'Referer: https://data.shom.fr/',
-        '-H', 'Sec-Fetch-Dest: image',
-        '-H', 'Sec-Fetch-Mode: cors',
-        '-H', 'Sec-Fetch-Site: same-site',
-        '-H', 'User-Agent: Mozilla/5.0 (X11; Linux x86_64; rv:138.0) Gecko/20100101 Firefox/138.0',
-        url,
-        '-o', str(outfile)
-    ]
+    outfile = Path(output_dir) / str(zoom) / str(x) / f"{y}.png"
+    url = tile_url(zoom, x, y)
+    data = None
+    
+    for attempt in range(MAX_RETRIES):
+        if attempt > 0:
+            async with stats_lock:
+                stats['retries'] += 1
+            await asyncio.sleep(delay)
+        
+        try:
+            async with semaphore:
+                # Gate on the actual send time, not on the time the task was queued
+                await pause_event.wait()
+                await rate_limiter.acquire()
+                async with stats_lock:
+                    stats['requests'] += 1
+                
+                async with session.get(url) as response:
+                    if response.status == 429:
+                        status = "throttled"
+                        delay = retry_after_delay(response, attempt)
+                    elif response.status >= 500:
+                        status = f"http_{response.status}"
+                        delay = backoff_delay(attempt)
+                    else:
+                        data = await response.read()
+                        break
+        except asyncio.TimeoutError:
+            status = "timeout"
+            delay = backoff_delay(attempt)
+        except aiohttp.ClientError as e:
+            status = f"error: {e}"
+            delay = backoff_delay(attempt)
+        
+        if status == "throttled":
+            await record_throttle()
+    
+    if data is None:
+        return False, status
+    
+    # Verify it's actually a PNG before it reaches the disk
+    if len(data) <= MIN_TILE_SIZE or data[:8] != PNG_MAGIC:
+        return False, "invalid_response"
     
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=30)
+        async with aiofiles.open(outfile, 'wb') as f:
+            await f.write(data)
         
-        # Check if file exists and has content
-        if outfile.exists() and outfile.stat().st_size > 1000:  # Minimum size for valid PNG
-            # Verify it's actually a PNG
-            with open(outfile, 'rb') as f:
-                header = f.read(8)
-                if header.startswith(b'\x89PNG\r\n\x1a\n'):
-                    return True, "downloaded"
+        return True, "downloaded"
         
-        # If we get here, download failed
+    except Exception as e:
         if outfile.exists():
-            outfile.unlink()  # Remove empty/invalid file
+            outfile.unlink()
+        return False, f"error: {e}"
+
+async def download_all(tiles, output_dir):
+    """Download every (zoom, x, y) tile concurrently over a shared session"""
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    connector = aiohttp.TCPConnector(limit_per_host=CONCURRENCY, keepalive_timeout=75)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    done = 0
+    
+    async def fetch(zoom, x, y):
+        nonlocal done
+        result = await download_tile(session, semaphore, zoom, x, y, output_dir)
+        done += 1
+        # Progress indicator
+        if done % 100 == 0:
+            print(f"  Progress: {done}/{len(tiles)} tiles")
+        return result
+    
+    pause_event.set()
+    async with aiohttp.ClientSession(connector=connector, headers=STATIC_HEADERS,
+                                     timeout=timeout) as session:
+        tasks = [fetch(zoom, x, y) for (zoom, x, y) in tiles]
+        return await asyncio.gather(*tasks)
+
+def existing_tiles(output_dir):
+    """Return the set of (zoom, x, y) tiles already downloaded in output_dir"""
+    existing = set()
+    if not os.path.isdir(output_dir):
+        return existing
+    
+    for zoom_dir in os.scandir(output_dir):
+        if not zoom_dir.is_dir() or not zoom_dir.name.isdigit():
+            continue
+        zoom = int(zoom_dir.name)
+        
+        for x_dir in os.scandir(zoom_dir.path):
+            if not x_dir.is_dir() or not x_dir.name.isdigit():
+                continue
+            x = int(x_dir.name)
             
-        return False, f"invalid_response"
+            for tile_file in os.scandir(x_dir.path):
+                name = tile_file.name
+                # Smaller files are leftovers of failed downloads and are fetched again
+                if (name.endswith('.png') and name[:-4].isdigit()
+                        and tile_file.stat().st_size > MIN_TILE_SIZE):
+                    existing.add((zoom, x, int(name[:-4])))
+    
+    return existing
+
+def create_tile_dirs(tiles, output_dir):
+    """Create the zoom/x directories of all tiles, once per directory"""
+    for zoom, x in {(zoom, x) for zoom, x, _ in tiles}:
+        (Path(output_dir) / str(zoom) / str(x)).mkdir(parents=True, exist_ok=True)
+
+def download_tiles(batch, output_dir):
+    """Download a batch of tiles with a single curl process"""
+    cmd = [*CURL_BASE, *CURL_HEADER_ARGS]
+    outfiles = []
+    
+    for zoom, x, y in batch:
+        outfile = Path(output_dir) / str(zoom) / str(x) / f"{y}.png"
+        cmd.extend(('-o', str(outfile), tile_url(zoom, x, y)))
+        outfiles.append(outfile)
+    
+    try:
+        rounds = len(batch) // CURL_PARALLEL + 1
+        output = subprocess.run(cmd, capture_output=True, timeout=TIMEOUT * (rounds + 1)).stdout
+    except subprocess.TimeoutExpired as e:
+        output = e.stdout or b''  # Transfers finished before curl was killed
+    
+    # curl exit code and HTTP status of every reported transfer, keyed by output file
+    codes = {}
+    for line in output.decode(errors='replace').splitlines():
+        exitcode, http_code, filename = line.split(' ', 2)
+        codes[filename] = (exitcode, http_code)
+    
+    results = []
+    for outfile in outfiles:
+        code = codes.get(str(outfile))
+        if code == ('0', '200'):
+            results.append(check_tile(outfile))
+            continue
         
-    except subprocess.TimeoutExpired:
+        # Unfinished or failed transfer, never keep a partial file
         if outfile.exists():
             outfile.unlink()
-        return False, "timeout"
-    except Exception as e:
-        if outfile.exists():
-            outfile.unlink()
-        return False, f"error: {e}"
+        timed_out = code is None or code[0] == '28'  # 28: curl operation timeout
+        results.append((False, "timeout" if timed_out else "invalid_response"))
+    
+    return results
+
+def download_all_curl(tiles, output_dir):
+    """Download every (zoom, x, y) tile in batches of curl processes"""
+    results = []
+    
+    for start in range(0, len(tiles), CURL_BATCH_SIZE):
+        results += download_tiles(tiles[start:start + CURL_BATCH_SIZE], output_dir)
+        # Progress indicator
+        print(f"  Progress: {len(results)}/{len(tiles)} tiles")
+    
+    return results
 
 def main():
     print(f"Downloading SHOM tiles for area: {MIN_LAT},{MIN_LON} to {MAX_LAT},{MAX_LON}")
     print(f"Zoom levels: {MIN_ZOOM} to {MAX_ZOOM}")
     
-    total_tiles = 0
-    downloaded = 0
-    skipped = 0
-    failed = 0
+    all_tiles = []
     
     for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
         print(f"\nProcessing zoom level {zoom}...")
         
         # Calculate tile bounds for this zoom level
-        min_x, max_y = deg2tile(MIN_LAT, MIN_LON, zoom)
-        max_x, min_y = deg2tile(MAX_LAT, MAX_LON, zoom)
-        
-        # Ensure we have the right bounds (min_y should be less than max_y)
-        if min_y > max_y:
-            min_y, max_y = max_y, min_y
+        xs, ys = tile_ranges(MIN_LAT, MAX_LAT, MIN_LON, MAX_LON, zoom)
             
-        print(f"Tile range for zoom {zoom}: X({min_x}-{max_x}) Y({min_y}-{max_y})")
-        
-        zoom_tiles = (max_x - min_x + 1) * (max_y - min_y + 1)
-        total_tiles += zoom_tiles
-        print(f"Expected tiles for this zoom level: {zoom_tiles}")
+        print(f"Tile range for zoom {zoom}: X({xs.start}-{xs.stop - 1}) Y({ys.start}-{ys.stop - 1})")
+        print(f"Expected tiles for this zoom level: {len(xs) * len(ys)}")
         
-        zoom_downloaded = 0
-        zoom_failed = 0
-        
-        for x in range(min_x, max_x + 1):
-            for y in range(min_y, max_y + 1):
-                success, status = download_tile(zoom, x, y, OUTPUT_DIR)
-                
-                if success:
-                    if status == "downloaded":
-                        downloaded += 1
-                        zoom_downloaded += 1
-                    else:  # exists
-                        skipped += 1
-                else:
-                    failed += 1
-                    zoom_failed += 1
-                    if zoom_failed <= 5:  # Only print first few errors per zoom level
-                        print(f"  Failed to download tile {zoom}/{x}/{y}: {status}")
-                
-                # Progress indicator
-                if (downloaded + skipped + failed) % 100 == 0:
-                    print(f"  Progress: Downloaded {zoom_downloaded}, Failed {zoom_failed}")
-        
-        print(f"Zoom {zoom} complete: {zoom_downloaded} downloaded, {zoom_failed} failed")
+        all_tiles.extend((zoom, x, y) for x, y in product(xs, ys))
+    
+    total_tiles = len(all_tiles)
+    
+    # Skip tiles already downloaded by a previous run
+    existing = existing_tiles(OUTPUT_DIR)
+    tiles = [tile for tile in all_tiles if tile not in existing]
+    skipped = total_tiles - len(tiles)
+    
+    # Download workers expect their output directory to exist
+    create_tile_dirs(tiles, OUTPUT_DIR)
+    
+    if aiohttp is not None:
+        print(f"\nDownloading {len(tiles)} tiles ({CONCURRENCY} concurrent requests, "
+              f"{skipped} already present)...")
+        results = asyncio.run(download_all(tiles, OUTPUT_DIR))
+    else:
+        print(f"\naiohttp not installed, downloading {len(tiles)} tiles with curl "
+              f"({CURL_BATCH_SIZE} per batch, {skipped} already present)...")
+        results = download_all_curl(tiles, OUTPUT_DIR)
+    
+    downloaded = 0
+    failed = 0
+    zoom_downloaded = {}
+    zoom_failed = {}
+    
+    for (zoom, x, y), (success, status) in zip(tiles, results):
+        if success:
+            downloaded += 1
+            zoom_downloaded[zoom] = zoom_downloaded.get(zoom, 0) + 1
+        else:
+            failed += 1
+            zoom_failed[zoom] = zoom_failed.get(zoom, 0) + 1
+            if zoom_failed[zoom] <= 5:  # Only print first few errors per zoom level
+                print(f"  Failed to download tile {zoom}/{x}/{y}: {status}")
+    
+    for zoom in range(MIN_ZOOM, MAX_ZOOM + 1):
+        print(f"Zoom {zoom} complete: {zoom_downloaded.get(zoom, 0)} downloaded, "
+              f"{zoom_failed.get(zoom, 0)} failed")
     
     print(f"\nFinal results:")
     print(f"  Total expected: {total_tiles}")
     print(f"  Downloaded: {downloaded}")
     print(f"  Skipped (existed): {skipped}")
     print(f"  Failed: {failed}")
+    if aiohttp is not None:
+        print(f"  Requests: {stats['requests']} ({stats['retries']} retries, "
+              f"{stats['throttled']} throttled, {stats['pauses']} pauses)")
     print(f"  Success rate: {((downloaded + skipped) / total_tiles * 100):.1f}%")
 
 if __name__ == "__main__":
@@ -4,13 +4,46 @@ import os
 import sqlite3
 import math
 import json
-from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass
+from itertools import islice
 
 # Configuration
 TILES_ROOT = "shom_tiles_complete"  # Update as needed
 TILE_FORMAT = "png"
 MBTILES_FILE = "shom_marine_charts.mbtiles"
 
+COMMIT_INTERVAL = 10000  # Rows per transaction
+PAGE_SIZE = 8192         # SQLite page size, tiles are tens of KB so fewer overflow pages
+READ_WORKERS = 8         # Threads reading tile files
+READ_AHEAD = 2000        # Tiles read ahead of the inserts
+
+# Index tiles while loading so map viewers can read the file during the build.
+# Slower than building the index once at the end, which is done when False.
+ONLINE_BUILD = False
+
+# Tile file name suffix, matched in lower or upper case
+SUFFIX = f'.{TILE_FORMAT}'
+SUFFIX_UPPER = SUFFIX.upper()
+SUFFIX_LEN = len(SUFFIX)
+
+# Leading bytes of valid tiles, files not starting with them are skipped
+TILE_MAGIC = {
+    'png': b'\x89PNG\r\n\x1a\n',
+    'jpg': b'\xff\xd8\xff',
+    'jpeg': b'\xff\xd8\xff',
+}.get(TILE_FORMAT, b'')
+
+@dataclass(slots=True)
+class ZoomInfo:
+    """Tile bounds and count of a zoom level"""
+    min_x: int = 2 ** 30
+    max_x: int = -1
+    min_y: int = 2 ** 30
+    max_y: int = -1
+    count: int = 0
+
 def deg2tile(lat, lon, zoom):
     """Convert lat/lon to tile coordinates"""
     lat_rad = math.radians(lat)
@@ -27,54 +60,6 @@ def tile2deg(x, y, zoom):
     lat = math.degrees(lat_rad)
     return lat, lon
 
-def flip_y(z, y):
-    """Flip Y coordinate for TMS scheme"""
-    return (2 ** z - 1) - y
-
-def analyze_tiles(tiles_root):
-    """Analyze tile structure and calculate bounds"""
-    zoom_levels = {}
-    
-    for zoom_dir in Path(tiles_root).iterdir():
-        if not zoom_dir.is_dir() or not zoom_dir.name.isdigit():
-            continue
-            
-        z = int(zoom_dir.name)
-        tiles_info = {
-            'min_x': float('inf'),
-            'max_x': float('-inf'),
-            'min_y': float('inf'),
-            'max_y': float('-inf'),
-            'count': 0
-        }
-        
-        for x_dir in zoom_dir.iterdir():
-            if not x_dir.is_dir() or not x_dir.name.isdigit():
-                continue
-                
-            x = int(x_dir.name)
-            
-            for tile_file in x_dir.iterdir():
-                if not tile_file.name.lower().endswith(f'.{TILE_FORMAT}'):
-                    continue
-                    
-                y_str = tile_file.stem
-                if not y_str.isdigit():
-                    continue
-                    
-                y = int(y_str)
-                
-                tiles_info['min_x'] = min(tiles_info['min_x'], x)
-                tiles_info['max_x'] = max(tiles_info['max_x'], x)
-                tiles_info['min_y'] = min(tiles_info['min_y'], y)
-                tiles_info['max_y'] = max(tiles_info['max_y'], y)
-                tiles_info['count'] += 1
-        
-        if tiles_info['count'] > 0:
-            zoom_levels[z] = tiles_info
-    
-    return zoom_levels
-
 def calculate_bounds(zoom_levels):
     """Calculate geographic bounds from tile data"""
     bounds = {
@@ -86,8 +71,8 @@ def calculate_bounds(zoom_levels):
     
     for z, info in zoom_levels.items():
         # Calculate bounds for this zoom level
-        min_lat, min_lon = tile2deg(info['min_x'], info['max_y'], z)
-        max_lat, max_lon = tile2deg(info['max_x'] + 1, info['min_y'], z)
+        min_lat, min_lon = tile2deg(info.min_x, info.max_y, z)
+        max_lat, max_lon = tile2deg(info.max_x + 1, info.min_y, z)
         
         bounds['min_lat'] = min(bounds['min_lat'], min_lat)
         bounds['max_lat'] = max(bounds['max_lat'], max_lat)
@@ -96,47 +81,168 @@ def calculate_bounds(zoom_levels):
     
     return bounds
 
-def create_mbtiles(tiles_root, output_file):
-    """Create MBTiles file from tile directory"""
+def extent_metadata(zoom_levels):
+    """MBTiles metadata describing the zoom levels and area loaded so far"""
+    bounds = calculate_bounds(zoom_levels)
+    min_zoom = min(zoom_levels.keys())
+    max_zoom = max(zoom_levels.keys())
     
-    print(f"Analyzing tiles in {tiles_root}...")
-    zoom_levels = analyze_tiles(tiles_root)
+    return {
+        "minzoom": str(min_zoom),
+        "maxzoom": str(max_zoom),
+        "bounds": f"{bounds['min_lon']},{bounds['min_lat']},{bounds['max_lon']},{bounds['max_lat']}",
+        "center": f"{(bounds['min_lon'] + bounds['max_lon'])/2},{(bounds['min_lat'] + bounds['max_lat'])/2},{min_zoom + 2}",
+    }
+
+def read_tile(path):
+    """Read a tile file, returning None if it is not a valid image"""
+    try:
+        # Verify it's a valid image, without opening undersized files
+        size = os.stat(path).st_size
+        if size < 100:  # Too small to be a valid image
+            print(f"Warning: Skipping {path} - file too small")
+            return None
+        
+        # Read straight into a buffer of the right size, bound without copy
+        tile_data = bytearray(size)
+        with open(path, 'rb', buffering=0) as f:
+            length = f.readinto(tile_data)
+    except Exception as e:
+        print(f"Error processing {path}: {e}")
+        return None
     
-    if not zoom_levels:
-        print("No tiles found!")
-        return False
+    if not tile_data.startswith(TILE_MAGIC):
+        print(f"Warning: Skipping {path} - not a {TILE_FORMAT} image")
+        return None
     
-    # Print analysis
-    print(f"Found {len(zoom_levels)} zoom levels:")
-    total_tiles = 0
-    for z in sorted(zoom_levels.keys()):
-        info = zoom_levels[z]
-        print(f"  Zoom {z}: {info['count']} tiles "
-              f"(X: {info['min_x']}-{info['max_x']}, "
-              f"Y: {info['min_y']}-{info['max_y']})")
-        total_tiles += info['count']
+    return memoryview(tile_data)[:length]
+
+def zoom_tile_files(zoom_path, tiles_info):
+    """Yield (x, y, path) for the tile files of a zoom level directory"""
+    # Directory order is kept as is: the tile index does not depend on insert order
+    for x_dir in os.scandir(zoom_path):
+        if not x_dir.is_dir() or not x_dir.name.isdigit():
+            continue
+        
+        x = int(x_dir.name)
+        count = tiles_info.count
+        
+        # One file per tile: whatever the listing order, the lowercase suffix
+        # wins over the same tile saved with an uppercase one (12.png over 12.PNG)
+        tiles = {}
+        for tile_file in os.scandir(x_dir.path):
+            name = tile_file.name
+            if name.endswith(SUFFIX):
+                lowercase = True
+            elif name.endswith(SUFFIX_UPPER):
+                lowercase = False
+            else:
+                continue
+            
+            y_str = name[:-SUFFIX_LEN]
+            if not y_str.isdigit():
+                continue
+            
+            if lowercase:
+                tiles[int(y_str)] = tile_file.path
+            else:
+                tiles.setdefault(int(y_str), tile_file.path)
+        
+        for y, path in tiles.items():
+            if y < tiles_info.min_y:
+                tiles_info.min_y = y
+            if y > tiles_info.max_y:
+                tiles_info.max_y = y
+            tiles_info.count += 1
+            
+            yield x, y, path
+        
+        # X is the same for the whole column, update its bounds once
+        if tiles_info.count > count:
+            if x < tiles_info.min_x:
+                tiles_info.min_x = x
+            if x > tiles_info.max_x:
+                tiles_info.max_x = x
+
+def scan_zoom(zoom_path):
+    """List the tile files of a zoom level directory and analyze their bounds
     
-    bounds = calculate_bounds(zoom_levels)
-    print(f"Geographic bounds: {bounds['min_lat']:.4f},{bounds['min_lon']:.4f} "
-          f"to {bounds['max_lat']:.4f},{bounds['max_lon']:.4f}")
+    Runs in a worker process, returns (tiles_info, [(x, y, path), ...]).
+    """
+    tiles_info = ZoomInfo()
+    files = list(zoom_tile_files(zoom_path, tiles_info))
+    return tiles_info, files
+
+def zoom_tile_rows(files, z, executor):
+    """Yield (zoom, x, TMS y, data) rows for the tile files of a zoom level
+    
+    The TMS flip is computed once per zoom level. Files are read by the
+    executor's threads up to READ_AHEAD tiles ahead of the rows consumed
+    by SQLite.
+    """
+    flip = (1 << z) - 1
+    pending = deque()
+    
+    def completed(limit):
+        while len(pending) > limit:
+            x, y, future = pending.popleft()
+            tile_data = future.result()
+            if tile_data is not None:
+                yield z, x, flip - y, tile_data
+    
+    for x, y, path in files:
+        pending.append((x, y, executor.submit(read_tile, path)))
+        yield from completed(READ_AHEAD)
+    
+    yield from completed(0)
+
+def create_mbtiles(tiles_root, output_file):
+    """Create MBTiles file from tile directory"""
     
     # Create database
-    if os.path.exists(output_file):
-        os.remove(output_file)
+    for path in (output_file, f"{output_file}-wal", f"{output_file}-shm"):
+        if os.path.exists(path):
+            os.remove(path)
     
-    conn = sqlite3.connect(output_file)
+    # Transactions are managed explicitly below
+    conn = sqlite3.connect(output_file, isolation_level=None)
     c = conn.cursor()
     
-    # Create tables
+    # Must be set before the first table is created to take effect
+    c.execute(f'PRAGMA page_size={PAGE_SIZE}')
+    
+    if ONLINE_BUILD:
+        # WAL lets map viewers read committed zoom levels while the build goes on.
+        # The file is rebuilt from scratch on failure, so NORMAL sync is enough.
+        c.executescript('''
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA wal_autocheckpoint=10000;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-200000;
+        ''')
+    else:
+        # The file is rebuilt from scratch on failure, so trade durability for speed
+        c.executescript('''
+        PRAGMA synchronous=OFF;
+        PRAGMA journal_mode=MEMORY;
+        PRAGMA locking_mode=EXCLUSIVE;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA cache_size=-200000;
+        ''')
+    
+    # Create tables (unless building online, the tiles index is built once all rows are loaded)
     c.execute('''
     CREATE TABLE tiles (
         zoom_level INTEGER,
         tile_column INTEGER,
         tile_row INTEGER,
-        tile_data BLOB,
-        PRIMARY KEY (zoom_level, tile_column, tile_row)
+        tile_data BLOB
     )''')
     
+    if ONLINE_BUILD:
+        c.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+    
     c.execute('''
     CREATE TABLE metadata (
         name TEXT,
@@ -144,69 +250,89 @@ def create_mbtiles(tiles_root, output_file):
         PRIMARY KEY (name)
     )''')
     
-    # Insert tiles
+    # Metadata known up front, committed so readers see it from the start
+    metadata = {
+        "name": "SHOM Marine Charts",
+        "format": TILE_FORMAT,
+        "version": "1.0",
+        "type": "overlay",
+        "attribution": "SHOM - Service Hydrographique et Océanographique de la Marine",
+    }
+    metadata_sql = 'INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)'
+    c.executemany(metadata_sql, metadata.items())
+    
+    # Insert tiles, analyzing the tile structure in the same pass
+    # (the scan yields a single file per tile, so rows never collide)
+    print(f"Loading tiles from {tiles_root}...")
+    insert_sql = 'INSERT INTO tiles (zoom_level, tile_column, tile_row, tile_data) VALUES (?, ?, ?, ?)'
+    zoom_levels = {}
     inserted = 0
     
-    for zoom_dir in sorted(Path(tiles_root).iterdir()):
-        if not zoom_dir.is_dir() or not zoom_dir.name.isdigit():
-            continue
-        
-        z = int(zoom_dir.name)
-        print(f"Processing zoom level {z}...")
-        
-        for x_dir in sorted(zoom_dir.iterdir()):
-            if not x_dir.is_dir() or not x_dir.name.isdigit():
-                continue
-            
-            x = int(x_dir.name)
+    c.execute('BEGIN')
+    
+    # Only zoom levels are sorted, to keep the progress output readable
+    zoom_dirs = sorted((entry for entry in os.scandir(tiles_root)
+                        if entry.is_dir() and entry.name.isdigit()),
+                       key=lambda entry: int(entry.name))
+    
+    # Zoom levels are scanned in parallel processes while earlier ones are inserted
+    if zoom_dirs:
+        scan_workers = min(len(zoom_dirs), os.cpu_count() or 1)
+        with ProcessPoolExecutor(max_workers=scan_workers) as scanner, \
+                ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+            scans = scanner.map(scan_zoom, [zoom_dir.path for zoom_dir in zoom_dirs])
             
-            for tile_file in sorted(x_dir.iterdir()):
-                if not tile_file.name.lower().endswith(f'.{TILE_FORMAT}'):
-                    continue
-                
-                y_str = tile_file.stem
-                if not y_str.isdigit():
-                    continue
+            for zoom_dir, (tiles_info, files) in zip(zoom_dirs, scans):
+                z = int(zoom_dir.name)
+                print(f"Processing zoom level {z}...")
                 
-                y = int(y_str)
-                flipped_y = flip_y(z, y)
+                rows = zoom_tile_rows(files, z, executor)
+                while True:
+                    c.executemany(insert_sql, islice(rows, COMMIT_INTERVAL))
+                    if c.rowcount <= 0:
+                        break
+                    inserted += c.rowcount
+                    c.execute('COMMIT')
+                    c.execute('BEGIN')
+                    print(f"  Inserted {inserted} tiles...")
                 
-                try:
-                    with open(tile_file, 'rb') as f:
-                        tile_data = f.read()
-                    
-                    # Verify it's a valid image
-                    if len(tile_data) < 100:  # Too small to be a valid image
-                        print(f"Warning: Skipping {tile_file} - file too small")
-                        continue
+                if tiles_info.count > 0:
+                    zoom_levels[z] = tiles_info
                     
-                    c.execute('''
-                    INSERT OR REPLACE INTO tiles (zoom_level, tile_column, tile_row, tile_data)
-                    VALUES (?, ?, ?, ?)
-                    ''', (z, x, flipped_y, tile_data))
-                    
-                    inserted += 1
-                    
-                    if inserted % 100 == 0:
-                        print(f"  Inserted {inserted}/{total_tiles} tiles...")
-                        
-                except Exception as e:
-                    print(f"Error processing {tile_file}: {e}")
+                    # Publish the extent covered so far with this zoom level
+                    c.executemany(metadata_sql, extent_metadata(zoom_levels).items())
+                    c.execute('COMMIT')
+                    c.execute('BEGIN')
+    
+    if not zoom_levels:
+        print("No tiles found!")
+        conn.close()
+        os.remove(output_file)
+        return False
+    
+    # Print analysis
+    print(f"Found {len(zoom_levels)} zoom levels:")
+    total_tiles = 0
+    for z in sorted(zoom_levels.keys()):
+        info = zoom_levels[z]
+        print(f"  Zoom {z}: {info.count} tiles "
+              f"(X: {info.min_x}-{info.max_x}, "
+              f"Y: {info.min_y}-{info.max_y})")
+        total_tiles += info.count
+    
+    bounds = calculate_bounds(zoom_levels)
+    print(f"Geographic bounds: {bounds['min_lat']:.4f},{bounds['min_lon']:.4f} "
+          f"to {bounds['max_lat']:.4f},{bounds['max_lon']:.4f}")
+    
+    if not ONLINE_BUILD:
+        print("Creating tile index...")
+        c.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
     
-    # Insert metadata
+    # Insert the remaining metadata
     min_zoom = min(zoom_levels.keys())
     max_zoom = max(zoom_levels.keys())
     
     metadata = {
-        "name": "SHOM Marine Charts",
-        "format": TILE_FORMAT,
-        "minzoom": str(min_zoom),
-        "maxzoom": str(max_zoom),
-        "bounds": f"{bounds['min_lon']},{bounds['min_lat']},{bounds['max_lon']},{bounds['max_lat']}",
-        "center": f"{(bounds['min_lon'] + bounds['max_lon'])/2},{(bounds['min_lat'] + bounds['max_lat'])/2},{min_zoom + 2}",
-        "version": "1.0",
-        "type": "overlay",
-        "attribution": "SHOM - Service Hydrographique et Océanographique de la Marine",
         "description": f"Marine charts from SHOM covering {bounds['min_lat']:.2f}°-{bounds['max_lat']:.2f}°N, {bounds['min_lon']:.2f}°-{bounds['max_lon']:.2f}°E",
         "tilestats": json.dumps({
             "layerCount": 1,
@@ -220,13 +346,21 @@ def create_mbtiles(tiles_root, output_file):
         })
     }
     
-    for k, v in metadata.items():
-        c.execute('INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)', (k, v))
+    c.executemany(metadata_sql, metadata.items())
     
-    # Create indexes for better performance
-    c.execute('CREATE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+    c.execute('COMMIT')
     
-    conn.commit()
+    # Leave a compact, portable file for OpenCPN
+    if ONLINE_BUILD:
+        c.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        try:
+            c.execute('PRAGMA journal_mode=DELETE')
+        except sqlite3.OperationalError as e:
+            print(f"Warning: Keeping WAL journal mode, the file is still open elsewhere ({e})")
+    else:
+        c.execute('PRAGMA journal_mode=DELETE')
+    c.execute('ANALYZE')
+    c.execute('VACUUM')
     conn.close()
     
     print(f"\nMBTiles creation complete!")